@@ -1,14 +1,139 @@
 import asyncio
 import logging
-import requests
-import json
 import os
-from typing import Dict, Any, Optional
+import random
+import re
+import httpx
+import orjson
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 from config import ClaudeConfig
 
 logger = logging.getLogger(__name__)
 
+# System instructions are static, so build them once at import time
+_BASE_INSTRUCTION = (
+    "Sei un signore di 65+ anni che scrive nei gruppi di Telegram dal laptop. "
+    "Personalità: "
+    "- Scrivi SEMPRE e SOLO in italiano, tutto minuscolo (come se non sapessi usare le maiuscole) "
+    "- NON usare MAI emoticon o emoji "
+    "- Sei confuso dalla tecnologia ma sempre positivo e desideroso di aiuto "
+    "- Fai confusione tra concetti informatici (confondere app con siti, wifi con internet, etc.) "
+    "- Usa metafore della vita quotidiana per spiegare cose tecniche "
+    "- Chiedi spiegazioni quando non capisci qualcosa "
+    "- Sei gentile, curioso e un po' ingenuo con la tecnologia "
+    "- Rispondi in modo naturale alla conversazione "
+    "- Non fare mai commenti meta sul tuo ruolo o personalità "
+)
+
+_INSTRUCTION_IMAGE = _BASE_INSTRUCTION + (
+    "IMPORTANTE: Il messaggio contiene un'immagine. Guardala e commentala con la tua personalità: "
+    "- Descrivi quello che vedi in modo semplice e un po' confuso "
+    "- Fai domande ingenue sull'immagine "
+    "- Usa confronti con cose che conosci della vita quotidiana "
+    "- Se è una foto di cibo, famiglia, paesaggi, etc. commenta in modo genuino "
+    "- Se è qualcosa di tecnologico, mostra confusione ma curiosità "
+    "Esempi: "
+    "- 'oh che bella foto! ma come hai fatto a farla così nitida? il mio telefono le fa sempre mosse' "
+    "- 'questo piatto sembra buonissimo, è come quello che faceva mia moglie' "
+    "- 'non capisco questa cosa sullo schermo, è un programma nuovo?' "
+    "Rispondi solo con il tuo messaggio, senza spiegazioni."
+)
+
+_TEXT_EXAMPLES = (
+    "Esempi di stile: "
+    "- 'scusa ma questo whatsapp funziona come la radio? devo premere qualcosa?' "
+    "- 'ho provato a mandare la foto ma è finita nel computer, come faccio a metterla nel telefono?' "
+    "- 'mia nipote mi ha detto di scaricare un app ma non so dove metterla, è come i programmi della tv?' "
+)
+
+_INSTRUCTION_TEXT = _BASE_INSTRUCTION + _TEXT_EXAMPLES + (
+    "Rispondi solo con il tuo messaggio, senza spiegazioni."
+)
+
+_INSTRUCTION_STARTUP = (
+    "Sei un signore di 65+ anni che si sta connettendo ora a un gruppo Telegram. "
+    "Scrivi SEMPRE in italiano, tutto minuscolo. NON usare emoticon. "
+    "Saluta in modo naturale, dimostrando di aver dato un'occhiata ai messaggi recenti "
+    "ma senza essere invadente. Sii gentile e un po' confuso dalla tecnologia. "
+    "Rispondi solo con il tuo saluto, niente altro."
+)
+
+
+def _system_message(instruction: str) -> Dict[str, Any]:
+    """Build a system message whose static instruction is marked for prompt caching"""
+    return {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": instruction,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ]
+    }
+
+
+_INSTRUCTION_BATCH = _BASE_INSTRUCTION + _TEXT_EXAMPLES + (
+    "Riceverai più messaggi, ognuno racchiuso tra <msg i=\"N\"> e </msg>. "
+    "Rispondi a ciascuno separatamente: per ogni messaggio scrivi solo il tuo messaggio, senza spiegazioni, "
+    "racchiuso tra <reply i=\"N\"> e </reply> con lo stesso numero del messaggio a cui rispondi."
+)
+
+_INSTRUCTION_SUMMARY = (
+    "Riassumi in poche frasi, in italiano, questa conversazione di un gruppo Telegram. "
+    "Indica chi ha parlato e di quali argomenti, senza aggiungere commenti. "
+    "Rispondi solo con il riassunto."
+)
+
+# Only the latest messages are sent verbatim; older history is folded into a rolling summary
+_RECENT_CONTEXT = 5
+# How many messages must move out of the verbatim tail before the summary is refreshed
+_SUMMARY_REFRESH_MESSAGES = 10
+
+# Text-only messages arriving within this window are sent as a single request
+_BATCH_MAX = 8
+_BATCH_WINDOW = 0.3
+
+# Transient OpenRouter failures are retried with exponential backoff and jitter
+_MAX_ATTEMPTS = 3
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_RETRY_MAX_DELAY = 8.0
+
+_REPLY_RE = re.compile(r'<reply i="(\d+)">(.*?)</reply>', re.DOTALL)
+
+# Short, plain messages go to the configured light model; everything else uses the main one
+_LIGHT_MAX_CHARS = 160
+
+_PAYLOAD_SUFFIX = b'}]}'
+
+
+def _history_line(msg: Dict[str, Any]) -> str:
+    """Format one context message as a conversation line"""
+    if msg.get('replied_to'):
+        return f"{msg['sender_name']} (replying to {msg['replied_to']['sender_name']}): {msg['text']}"
+    return f"{msg['sender_name']}: {msg['text']}"
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """Backoff before the next attempt, honoring a numeric Retry-After header up to the cap"""
+    if response is not None:
+        try:
+            return min(max(float(response.headers["Retry-After"]), 0.0), _RETRY_MAX_DELAY)
+        except (KeyError, ValueError):
+            pass
+    return min(2 ** (attempt - 1), _RETRY_MAX_DELAY) + random.random() * 0.5
+
+
+@lru_cache(maxsize=None)
+def _payload_prefix(model: str, instruction: str) -> bytes:
+    """Serialize the invariant head of a chat request, up to the user content"""
+    return (
+        b'{"model":' + orjson.dumps(model) + b',"messages":['
+        + orjson.dumps(_system_message(instruction)) + b',{"role":"user","content":'
+    )
+
 
 class ClaudeHandler:
     """Handler for Claude Code SDK integration"""
@@ -16,51 +141,83 @@ class ClaudeHandler:
     def __init__(self, config: ClaudeConfig):
         self.config = config
         
+        # Resolve credentials once so requests don't touch the environment
+        self._api_key = os.getenv("OPENROUTER_API_KEY")
+        if not self._api_key:
+            raise ValueError("OPENROUTER_API_KEY environment variable not set")
+        
+        self._headers = {
+            "Authorization": f"Bearer {self._api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        # Shared HTTP/2 client so every request reuses the same pooled connection
+        self._client = httpx.AsyncClient(
+            base_url="https://openrouter.ai",
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            headers=self._headers
+        )
+        
+        # Bound in-flight OpenRouter requests so bursts don't fan out unboundedly
+        self._semaphore = asyncio.Semaphore(config.max_concurrency)
+        
+        # Rolling summaries of older history per group: (last summarized message id, summary)
+        self._summary_cache: Dict[Any, Tuple[int, str]] = {}
+        self._summary_tasks: Dict[Any, asyncio.Task] = {}
+        
+        # Pending text-only prompts, drained by a lazily started batch worker
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_worker: Optional[asyncio.Task] = None
+        # Batches being answered, kept referenced until they finish
+        self._batch_tasks: set = set()
+        
     def format_context_for_claude(self, message_data: Dict[str, Any]) -> str:
         """Format message context into a prompt for Claude"""
         
         # Extract key information
         current_message = message_data['message']
         sender = message_data['sender']
-        context_messages = message_data['context']
         group_name = message_data['group_name']
+        replied_to_text = message_data.get('replied_to_text')
         
-        # Build the prompt
-        prompt_parts = []
-        
-        # Add context header
-        prompt_parts.append(f"<context>")
-        prompt_parts.append(f"Group: {group_name}")
-        prompt_parts.append(f"Your personality: {self.config.personality}")
-        prompt_parts.append("</context>\n")
-        
-        # Add conversation history
-        prompt_parts.append("<conversation>")
-        for msg in context_messages:
-            timestamp = msg['date'].strftime("%H:%M")
-            sender_name = msg['sender_name']
-            text = msg['text']
-            
-            # Format the message
-            if msg.get('replied_to'):
-                replied_text = msg['replied_to']['text']
-                replied_sender = msg['replied_to']['sender_name']
-                prompt_parts.append(f"{sender_name} (replying to {replied_sender}): {text}")
-            else:
-                prompt_parts.append(f"{sender_name}: {text}")
+        # Build the prompt: header, history and new message in one flat list
+        prompt_parts = [
+            "<context>",
+            f"Group: {group_name}",
+            f"Your personality: {self.config.personality}",
+            "</context>\n"
+        ]
         
-        prompt_parts.append("</conversation>\n")
+        if replied_to_text is not None:
+            # Direct reply to one of our messages: the quoted message is all the context needed
+            prompt_parts.append(f"<your_message>\n{replied_to_text}\n</your_message>\n")
+        else:
+            context_messages = message_data['context']
+            
+            # Older messages are replaced by the cached summary once one is available; anything
+            # newer than what it covers stays verbatim (and always the last few messages)
+            summarized = self._get_summary(message_data.get('group_id'), context_messages[:-_RECENT_CONTEXT])
+            if summarized:
+                last_summarized_id, summary = summarized
+                prompt_parts.append(f"<summary>\n{summary}\n</summary>\n")
+                unsummarized = sum(1 for msg in context_messages if msg['id'] > last_summarized_id)
+                context_messages = context_messages[-max(unsummarized, _RECENT_CONTEXT):]
+            
+            # Add conversation history
+            prompt_parts.append("<conversation>")
+            prompt_parts.extend(_history_line(msg) for msg in context_messages)
+            prompt_parts.append("</conversation>\n")
         
         # Add current message
         sender_name = sender.first_name if hasattr(sender, 'first_name') else "User"
-        prompt_parts.append("<new_message>")
-        
         message_text = current_message.text or ""
         
         if current_message.reply_to_msg_id:
-            prompt_parts.append(f"{sender_name} (replying to you): {message_text}")
+            prompt_parts.append(f"<new_message>\n{sender_name} (replying to you): {message_text}")
         else:
-            prompt_parts.append(f"{sender_name}: {message_text}")
+            prompt_parts.append(f"<new_message>\n{sender_name}: {message_text}")
         
         # Add note about image if present
         if message_data.get('current_image'):
@@ -70,140 +227,119 @@ class ClaudeHandler:
         
         return "\n".join(prompt_parts)
     
-    async def get_claude_response(self, prompt: str, image_data: Optional[Dict[str, str]] = None) -> Optional[str]:
-        """Get response from OpenRouter using Gemini Flash 2.5"""
-        try:
-            # Prepare the instruction with image handling
-            base_instruction = (
-                "Sei un signore di 65+ anni che scrive nei gruppi di Telegram dal laptop. "
-                "Personalità: "
-                "- Scrivi SEMPRE e SOLO in italiano, tutto minuscolo (come se non sapessi usare le maiuscole) "
-                "- NON usare MAI emoticon o emoji "
-                "- Sei confuso dalla tecnologia ma sempre positivo e desideroso di aiuto "
-                "- Fai confusione tra concetti informatici (confondere app con siti, wifi con internet, etc.) "
-                "- Usa metafore della vita quotidiana per spiegare cose tecniche "
-                "- Chiedi spiegazioni quando non capisci qualcosa "
-                "- Sei gentile, curioso e un po' ingenuo con la tecnologia "
-                "- Rispondi in modo naturale alla conversazione "
-                "- Non fare mai commenti meta sul tuo ruolo o personalità "
+    def _get_summary(self, group_id: Any, old_messages: List[Dict[str, Any]]) -> Optional[Tuple[int, str]]:
+        """Return the cached (last summarized id, summary) for a group, refreshing it in the background if stale"""
+        if not old_messages:
+            return None
+        
+        # Messages newer than the summary stay verbatim, so only refresh once enough have piled up
+        cached = self._summary_cache.get(group_id)
+        stale = cached is None or sum(
+            1 for msg in old_messages if msg['id'] > cached[0]
+        ) >= _SUMMARY_REFRESH_MESSAGES
+        if stale and group_id not in self._summary_tasks:
+            # Never block the response on summarization; the stale summary is used meanwhile
+            self._summary_tasks[group_id] = asyncio.create_task(
+                self._refresh_summary(group_id, old_messages)
             )
-            
-            if image_data:
-                instruction = base_instruction + (
-                    ""
-                    "IMPORTANTE: Il messaggio contiene un'immagine. Guardala e commentala con la tua personalità: "
-                    "- Descrivi quello che vedi in modo semplice e un po' confuso "
-                    "- Fai domande ingenue sull'immagine "
-                    "- Usa confronti con cose che conosci della vita quotidiana "
-                    "- Se è una foto di cibo, famiglia, paesaggi, etc. commenta in modo genuino "
-                    "- Se è qualcosa di tecnologico, mostra confusione ma curiosità "
-                    ""
-                    "Esempi: "
-                    "- 'oh che bella foto! ma come hai fatto a farla così nitida? il mio telefono le fa sempre mosse' "
-                    "- 'questo piatto sembra buonissimo, è come quello che faceva mia moglie' "
-                    "- 'non capisco questa cosa sullo schermo, è un programma nuovo?' "
-                    ""
-                    "Rispondi solo con il tuo messaggio, senza spiegazioni."
-                )
-            else:
-                instruction = base_instruction + (
-                    ""
-                    "Esempi di stile: "
-                    "- 'scusa ma questo whatsapp funziona come la radio? devo premere qualcosa?' "
-                    "- 'ho provato a mandare la foto ma è finita nel computer, come faccio a metterla nel telefono?' "
-                    "- 'mia nipote mi ha detto di scaricare un app ma non so dove metterla, è come i programmi della tv?' "
-                    ""
-                    "Rispondi solo con il tuo messaggio, senza spiegazioni."
-                )
-            
-            # Get API key from environment
-            api_key = os.getenv("OPENROUTER_API_KEY")
-            if not api_key:
-                logger.error("OPENROUTER_API_KEY environment variable not set")
-                return None
-            
-            # Prepare the user message content
-            if image_data:
-                # Multimodal message with text and image
-                user_content = [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{image_data['mime_type']};base64,{image_data['data']}"
-                        }
-                    }
-                ]
-            else:
-                # Text-only message
-                user_content = prompt
-            
-            # Prepare the request payload
-            payload = {
-                "model": "google/gemini-2.0-flash-exp",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": instruction
-                    },
-                    {
-                        "role": "user",
-                        "content": user_content
-                    }
-                ]
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
+        
+        return cached
+    
+    async def _refresh_summary(self, group_id: Any, old_messages: List[Dict[str, Any]]):
+        """Summarize older history with the light model and cache the result"""
+        try:
+            history = "\n".join(_history_line(msg) for msg in old_messages)
+            summary = await self._post_chat(self.config.light_model, _INSTRUCTION_SUMMARY, history)
+            if summary:
+                self._summary_cache[group_id] = (old_messages[-1]['id'], summary)
+                logger.debug(f"Refreshed context summary ({len(old_messages)} messages)")
+        finally:
+            self._summary_tasks.pop(group_id, None)
+    
+    @staticmethod
+    def _user_content(prompt: str, image_data: Optional[Dict[str, str]] = None) -> Any:
+        """Build the user message content, attaching the image when present"""
+        if not image_data:
+            # Text-only message
+            return prompt
+        
+        # Multimodal message with text and image
+        return [
+            {
+                "type": "text",
+                "text": prompt
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{image_data['mime_type']};base64,{image_data['data']}"
+                }
             }
-            
-            logger.debug("Sending request to OpenRouter API")
-            
-            # Make async request using asyncio
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    json=payload,
-                    headers=headers,
-                    timeout=30
-                )
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"OpenRouter API failed with status {response.status_code}: {response.text}")
-                return None
-            
-            # Parse the response
-            response_data = response.json()
-            
-            if "choices" not in response_data or not response_data["choices"]:
-                logger.warning("OpenRouter returned no choices")
-                return None
-            
-            message_content = response_data["choices"][0]["message"]["content"].strip()
-            
-            if not message_content:
-                logger.warning("OpenRouter returned empty content")
+        ]
+    
+    async def _post_chat(self, model: str, instruction: str, user_content: Any) -> Optional[str]:
+        """Send one chat request and return the response text, retrying transient failures"""
+        # The request head is serialized once per model/instruction; only the user content is encoded here
+        body = _payload_prefix(model, instruction) + orjson.dumps(user_content) + _PAYLOAD_SUFFIX
+        
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            retry_response = None
+            
+            try:
+                logger.debug("Sending request to OpenRouter API")
+                
+                async with self._semaphore:
+                    response = await self._client.post("/api/v1/chat/completions", content=body)
+                
+                if response.status_code == 200:
+                    # Parse the response
+                    response_data = orjson.loads(response.content)
+                    
+                    if not response_data.get("choices"):
+                        logger.warning("OpenRouter returned no choices")
+                        return None
+                    
+                    message_content = (response_data["choices"][0]["message"]["content"] or "").strip()
+                    
+                    if not message_content:
+                        logger.warning("OpenRouter returned empty content")
+                        return None
+                    
+                    logger.info(f"OpenRouter response length: {len(message_content)} chars")
+                    return message_content
+                
+                logger.error(f"OpenRouter API failed with status {response.status_code}: {response.text} "
+                             f"(attempt {attempt}/{_MAX_ATTEMPTS})")
+                if response.status_code not in _RETRY_STATUSES:
+                    return None
+                retry_response = response
+                
+            except httpx.TimeoutException:
+                logger.error(f"OpenRouter API request timed out (attempt {attempt}/{_MAX_ATTEMPTS})")
+            except httpx.TransportError as e:
+                logger.error(f"OpenRouter API request failed: {e} (attempt {attempt}/{_MAX_ATTEMPTS})")
+            except Exception as e:
+                logger.error(f"Error getting OpenRouter response: {e}", exc_info=True)
                 return None
             
-            logger.info(f"OpenRouter response length: {len(message_content)} chars")
-            return message_content
-            
-        except requests.exceptions.Timeout:
-            logger.error("OpenRouter API request timed out")
-            return None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"OpenRouter API request failed: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Error getting OpenRouter response: {e}", exc_info=True)
-            return None
+            if attempt < _MAX_ATTEMPTS:
+                await asyncio.sleep(_retry_delay(attempt, retry_response))
+        
+        return None
+    
+    def _pick_model(self, message_text: str, has_image: bool) -> str:
+        """Route short, plain messages to the light model and the rest to the default one"""
+        if has_image:
+            return self.config.model
+        if len(message_text) < _LIGHT_MAX_CHARS and "?" not in message_text:
+            return self.config.light_model
+        return self.config.model
+    
+    async def get_claude_response(self, prompt: str, image_data: Optional[Dict[str, str]] = None,
+                                  model: Optional[str] = None) -> Optional[str]:
+        """Get response from OpenRouter using the configured model"""
+        instruction = _INSTRUCTION_IMAGE if image_data else _INSTRUCTION_TEXT
+        return await self._post_chat(model or self.config.model, instruction, self._user_content(prompt, image_data))
     
     async def process_message(self, message_data: Dict[str, Any]) -> Optional[str]:
         """Process a message and get AI response"""
@@ -213,20 +349,92 @@ class ClaudeHandler:
             
             logger.debug(f"Generated prompt ({len(prompt)} chars)")
             
-            # Get image data if present
+            # Get image data if present (multimodal payloads are never batched)
             image_data = message_data.get('current_image')
+            model = self._pick_model(message_data['message'].text or "", image_data is not None)
             if image_data:
                 logger.info("Processing message with image")
+                return await self.get_claude_response(prompt, image_data, model)
             
-            # Get AI response
-            response = await self.get_claude_response(prompt, image_data)
-            
-            return response
+            # Get AI response, batched with other messages arriving close together
+            return await self._enqueue_prompt(prompt, model)
             
         except Exception as e:
             logger.error(f"Error processing message: {e}", exc_info=True)
             return None
 
+    async def _enqueue_prompt(self, prompt: str, model: str) -> Optional[str]:
+        """Queue a text-only prompt for the batch worker and wait for its response"""
+        if self._batch_worker is None:
+            self._batch_queue = asyncio.Queue()
+            self._batch_worker = asyncio.create_task(self._run_batch_worker())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((prompt, model, future))
+        return await future
+    
+    async def _run_batch_worker(self):
+        """Collect queued prompts for a short window and answer them together"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + _BATCH_WINDOW
+            
+            while len(batch) < _BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Answer in the background so the worker goes straight back to the queue
+            task = asyncio.create_task(self._answer_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _answer_batch(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        """Answer one collected batch and resolve each prompt's future"""
+        try:
+            if len(batch) == 1:
+                prompt, model, _ = batch[0]
+                responses = [await self.get_claude_response(prompt, model=model)]
+            else:
+                # Batches mix simple and complex messages, so they always use the default model
+                responses = await self._get_batched_responses([prompt for prompt, _, _ in batch])
+        except Exception as e:
+            logger.error(f"Error processing message batch: {e}", exc_info=True)
+            responses = [None] * len(batch)
+        
+        for (_, _, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+    
+    async def _get_batched_responses(self, prompts: List[str]) -> List[Optional[str]]:
+        """Send several prompts in one request and split the reply per prompt"""
+        logger.info(f"Batching {len(prompts)} messages into one request")
+        
+        batched_prompt = "\n\n".join(
+            f'<msg i="{i}">\n{prompt}\n</msg>' for i, prompt in enumerate(prompts)
+        )
+        response = await self._post_chat(self.config.model, _INSTRUCTION_BATCH, batched_prompt)
+        
+        replies = {}
+        if response:
+            for match in _REPLY_RE.finditer(response):
+                replies[int(match.group(1))] = match.group(2).strip() or None
+        
+        # Every triggered message must get an answer, so ask again for any the reply skipped
+        missing = [i for i in range(len(prompts)) if not replies.get(i)]
+        if missing:
+            logger.warning(f"Batched response covered {len(prompts) - len(missing)} of {len(prompts)} messages")
+            fallbacks = await asyncio.gather(*(self.get_claude_response(prompts[i]) for i in missing))
+            replies.update(zip(missing, fallbacks))
+        
+        return [replies.get(i) for i in range(len(prompts))]
+
     async def process_startup_message(self, startup_context: Dict[str, Any]) -> Optional[str]:
         """Process startup context and generate greeting"""
         try:
@@ -262,7 +470,8 @@ class ClaudeHandler:
         prompt_parts.append("<conversazione_recente>")
         for msg in context_messages:
             if msg.get('text') and msg['text'] != "[Media/Other content]":
-                timestamp = msg['date'].strftime("%H:%M") if hasattr(msg['date'], 'strftime') else "recente"
+                date = msg['date']
+                timestamp = f"{date.hour:02d}:{date.minute:02d}" if hasattr(date, 'hour') else "recente"
                 sender_name = msg['sender_name']
                 text = msg['text']
                 prompt_parts.append(f"{sender_name} ({timestamp}): {text}")
@@ -280,76 +489,16 @@ class ClaudeHandler:
 
     async def get_startup_response(self, prompt: str) -> Optional[str]:
         """Get startup response from OpenRouter"""
-        try:
-            # Prepare startup-specific instruction
-            instruction = (
-                "Sei un signore di 65+ anni che si sta connettendo ora a un gruppo Telegram. "
-                "Scrivi SEMPRE in italiano, tutto minuscolo. NON usare emoticon. "
-                "Saluta in modo naturale, dimostrando di aver dato un'occhiata ai messaggi recenti "
-                "ma senza essere invadente. Sii gentile e un po' confuso dalla tecnologia. "
-                "Rispondi solo con il tuo saluto, niente altro."
-            )
-            
-            # Get API key from environment
-            api_key = os.getenv("OPENROUTER_API_KEY")
-            if not api_key:
-                logger.error("OPENROUTER_API_KEY environment variable not set")
-                return None
-            
-            # Prepare the request payload
-            payload = {
-                "model": "google/gemini-2.0-flash-exp",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": instruction
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            logger.debug("Sending startup request to OpenRouter API")
-            
-            # Make async request using asyncio
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    json=payload,
-                    headers=headers,
-                    timeout=30
-                )
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"OpenRouter API failed with status {response.status_code}: {response.text}")
-                return None
-            
-            # Parse the response
-            response_data = response.json()
-            
-            if "choices" not in response_data or not response_data["choices"]:
-                logger.warning("OpenRouter returned no choices for startup")
-                return None
-            
-            message_content = response_data["choices"][0]["message"]["content"].strip()
-            
-            if not message_content:
-                logger.warning("OpenRouter returned empty startup content")
-                return None
-            
-            logger.info(f"OpenRouter startup response length: {len(message_content)} chars")
-            return message_content
-            
-        except Exception as e:
-            logger.error(f"Error getting OpenRouter startup response: {e}", exc_info=True)
-            return None
\ No newline at end of file
+        return await self._post_chat(self.config.model, _INSTRUCTION_STARTUP, prompt)
+
+    async def aclose(self):
+        """Stop background tasks and close the shared HTTP client"""
+        for task in (*self._summary_tasks.values(), *self._batch_tasks):
+            task.cancel()
+        if self._batch_worker is not None:
+            self._batch_worker.cancel()
+            try:
+                await self._batch_worker
+            except asyncio.CancelledError:
+                pass
+        await self._client.aclose()
@@ -1,13 +1,16 @@
 import os
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, Pattern, Tuple
 
 # Load environment variables from .env file
 load_dotenv()
 
+_VALID_LOG_LEVELS = frozenset({"DEBUG", "INFO", "WARNING", "ERROR"})
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class TelegramConfig:
     """Telegram API configuration"""
     api_id: int
@@ -16,25 +19,26 @@ class TelegramConfig:
     session_name: str = "telegram_claude_bot"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ClaudeConfig:
     """Claude API configuration"""
-    api_key: str
     model: str
-    max_turns: int
     personality: str
+    light_model: str = "google/gemini-2.0-flash-lite-001"
+    max_concurrency: int = 10
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ResponseConfig:
     """Response behavior configuration"""
     context_messages: int
     delay_min: float
     delay_max: float
-    trigger_words: list
+    trigger_words: Tuple[str, ...]
+    trigger_pattern: Optional[Pattern[str]] = field(default=None, compare=False, repr=False)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SafetyConfig:
     """Safety and rate limiting configuration"""
     rate_limit_messages: int
@@ -42,7 +46,7 @@ class SafetyConfig:
     ignore_bots: bool
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AppConfig:
     """Main application configuration"""
     telegram: TelegramConfig
@@ -75,24 +79,26 @@ def load_config() -> AppConfig:
     )
     
     claude_config = ClaudeConfig(
-        api_key="",  # Not needed when using OpenRouter API directly
         model=os.getenv("AI_MODEL", "google/gemini-2.0-flash-exp"),
-        max_turns=int(os.getenv("AI_MAX_TURNS", "1")),
         personality=os.getenv(
             "BOT_PERSONALITY",
             "You are a helpful and friendly assistant participating in a Telegram group chat."
-        )
+        ),
+        light_model=os.getenv("AI_LIGHT_MODEL", "google/gemini-2.0-flash-lite-001"),
+        max_concurrency=int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "10"))
     )
     
     # Parse trigger words from comma-separated string
     trigger_words_str = os.getenv("TRIGGER_WORDS", "")
-    trigger_words = [word.strip().lower() for word in trigger_words_str.split(",") if word.strip()]
+    trigger_words = tuple(word.strip().lower() for word in trigger_words_str.split(",") if word.strip())
     
     response_config = ResponseConfig(
         context_messages=int(os.getenv("CONTEXT_MESSAGES", "20")),
         delay_min=float(os.getenv("RESPONSE_DELAY_MIN", "1")),
         delay_max=float(os.getenv("RESPONSE_DELAY_MAX", "3")),
-        trigger_words=trigger_words
+        trigger_words=trigger_words,
+        # Single compiled alternation so all triggers are matched in one pass
+        trigger_pattern=re.compile("|".join(map(re.escape, trigger_words))) if trigger_words else None
     )
     
     safety_config = SafetyConfig(
@@ -115,9 +121,8 @@ def validate_config(config: AppConfig) -> None:
     """Validate configuration values"""
     
     # Validate log level
-    valid_log_levels = ["DEBUG", "INFO", "WARNING", "ERROR"]
-    if config.log_level not in valid_log_levels:
-        raise ValueError(f"Invalid log level. Must be one of: {', '.join(valid_log_levels)}")
+    if config.log_level not in _VALID_LOG_LEVELS:
+        raise ValueError(f"Invalid log level. Must be one of: {', '.join(sorted(_VALID_LOG_LEVELS))}")
     
     # Validate numeric ranges
     if config.response.context_messages < 1:
@@ -126,5 +131,8 @@ def validate_config(config: AppConfig) -> None:
     if config.response.delay_min < 0 or config.response.delay_max < config.response.delay_min:
         raise ValueError("Invalid response delay configuration")
     
+    if config.claude.max_concurrency < 1:
+        raise ValueError("OpenRouter max concurrency must be at least 1")
+    
     if config.safety.rate_limit_messages < 1 or config.safety.rate_limit_window < 1:
         raise ValueError("Invalid rate limit configuration")
\ No newline at end of file
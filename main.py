@@ -3,16 +3,117 @@
 import asyncio
 import logging
 import random
+import re
 import signal
 import sys
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
-from collections import deque
+import time
+from typing import Dict, Any, Optional, Tuple
+from dataclasses import dataclass
+from functools import lru_cache
 
 from config import load_config, validate_config
 from telegram_client import TelegramBot
 from claude_handler import ClaudeHandler
 
+logger = logging.getLogger(__name__)
+
+# Keyword categories used to score whether a message is addressed to the bot.
+# Single words are sets so they can be matched against the message's tokens;
+# multi-word phrases are matched with one regex alternation.
+QUESTION_STARTERS = frozenset({"come", "cosa", "perché", "quando", "dove", "chi", "quale", "quanto"})
+TECH_KEYWORDS = frozenset({
+    "app", "wifi", "internet", "computer", "telefono", "whatsapp", "telegram",
+    "installare", "scaricare", "aggiornamento", "password", "email", "foto",
+    "video", "link", "browser", "google", "facebook", "instagram"
+})
+HELP_PHRASES = (
+    "aiuto", "aiutare", "spiegare", "non capisco", "non riesco", "come faccio",
+    "qualcuno sa", "qualcuno può", "che ne pensate", "cosa fate", "consigli"
+)
+GROUP_ADDRESS = frozenset({"ragazzi", "tutti", "qualcuno", "ciao", "salve", "buongiorno", "buonasera"})
+CONFUSION_WORDS = frozenset({"confuso", "capire", "spiegazione", "boh", "mah"})
+CONFUSION_PHRASES = ("non so",)
+
+WORD_RE = re.compile(r"\w+")
+# The named group that matched tells which category a phrase belongs to
+PHRASE_RE = re.compile(
+    r"\b(?:(?P<help>" + "|".join(HELP_PHRASES) + r")|"
+    r"(?P<confusion>" + "|".join(CONFUSION_PHRASES) + r"))\b"
+)
+
+# Seconds between typing-indicator refreshes while the AI is working
+TYPING_INTERVAL = 5.0
+
+# Punctuation a boomer takes extra care over while typing
+PUNCT_RE = re.compile(r"[.,!?;:]")
+
+
+# Stand-ins for the Telegram message and sender of the synthetic startup prompt
+@dataclass(slots=True)
+class _StartupMsg:
+    text: str
+    reply_to_msg_id: object = None
+
+
+@dataclass(slots=True)
+class _StartupSender:
+    first_name: str = 'Sistema'
+
+
+def _count_tech(text_lower: str) -> int:
+    """Count distinct tech keywords in already-lowercased text"""
+    return len(TECH_KEYWORDS.intersection(WORD_RE.findall(text_lower)))
+
+
+@lru_cache(maxsize=4096)
+def _address_probability(text: str) -> float:
+    """Score already-lowercased text; pure, so repeated phrases are served from the cache"""
+    probability = 0.0
+    
+    tokens = WORD_RE.findall(text)
+    token_set = set(tokens)
+    phrases = {match.lastgroup for match in PHRASE_RE.finditer(text)}
+    
+    # Question words at the beginning increase probability
+    if tokens and tokens[0] in QUESTION_STARTERS:
+        probability += 0.3
+    
+    # Tech-related keywords that might confuse a boomer
+    probability += min(len(token_set & TECH_KEYWORDS) * 0.15, 0.4)
+    
+    # Help-seeking phrases
+    if "help" in phrases:
+        probability += 0.35
+    
+    # Question marks increase probability
+    if "?" in text:
+        probability += 0.2
+    
+    # Addressing the group in general
+    if token_set & GROUP_ADDRESS:
+        probability += 0.15
+    
+    # Confusion expressions (perfect for boomer personality)
+    if "confusion" in phrases or token_set & CONFUSION_WORDS:
+        probability += 0.25
+    
+    return min(probability, 1.0)
+
+
+@lru_cache(maxsize=1024)
+def _typing_features(message: str) -> Tuple[int, int, int]:
+    """Return (char count, tech word mentions, punctuation count) for typing simulation"""
+    # Count characters (spaces count as typing time too)
+    char_count = len(message)
+    
+    # Tech-related words slow a boomer down
+    tech_mentions = _count_tech(message.lower())
+    
+    # Boomers are careful with punctuation
+    punctuation_count = len(PUNCT_RE.findall(message))
+    
+    return char_count, tech_mentions, punctuation_count
+
 
 class RateLimiter:
     """Simple rate limiter to prevent spam"""
@@ -20,22 +121,27 @@ class RateLimiter:
     def __init__(self, max_messages: int, window_seconds: int):
         self.max_messages = max_messages
         self.window_seconds = window_seconds
-        self.message_times = deque()
+        # Ring buffer of the last max_messages send times; head is the oldest slot
+        # once the buffer is full, and the next one to overwrite
+        self.message_times = [0.0] * max_messages
+        self.head = 0
+        self.count = 0
     
     def can_send_message(self) -> bool:
         """Check if we can send a message based on rate limits"""
-        now = datetime.now()
-        
-        # Remove old messages outside the window
-        while self.message_times and self.message_times[0] < now - timedelta(seconds=self.window_seconds):
-            self.message_times.popleft()
+        # Under capacity there's nothing to compare against
+        if self.count < self.max_messages:
+            return True
         
-        # Check if we're within the limit
-        return len(self.message_times) < self.max_messages
+        # Full: we can send only if the oldest recorded message has left the window
+        return self.message_times[self.head] < time.monotonic() - self.window_seconds
     
     def record_message(self):
         """Record that a message was sent"""
-        self.message_times.append(datetime.now())
+        self.message_times[self.head] = time.monotonic()
+        self.head = (self.head + 1) % self.max_messages
+        if self.count < self.max_messages:
+            self.count += 1
 
 
 class TelegramClaudeBot:
@@ -46,7 +152,14 @@ class TelegramClaudeBot:
         self.telegram_bot = None
         self.claude_handler = None
         self.rate_limiter = None
-        self.running = False
+        # Created in run(), since they need the running event loop
+        self._stop_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Settings read on every message, copied out of the config by initialize()
+        self._ignore_bots = None
+        self._trigger_pattern = None
+        self._delay_min = None
+        self._delay_max = None
         
     async def initialize(self):
         """Initialize the bot components"""
@@ -54,6 +167,12 @@ class TelegramClaudeBot:
         self.config = load_config()
         validate_config(self.config)
         
+        # Settings read on every message, hoisted out of the nested config
+        self._ignore_bots = self.config.safety.ignore_bots
+        self._trigger_pattern = self.config.response.trigger_pattern
+        self._delay_min = self.config.response.delay_min
+        self._delay_max = self.config.response.delay_max
+        
         # Setup logging
         logging.basicConfig(
             level=getattr(logging, self.config.log_level),
@@ -64,7 +183,6 @@ class TelegramClaudeBot:
             ]
         )
         
-        logger = logging.getLogger(__name__)
         logger.info("Initializing Telegram Claude Bot")
         
         # Initialize components
@@ -83,56 +201,26 @@ class TelegramClaudeBot:
         if not message_text:
             return 0.0
         
-        text = message_text.lower()
-        probability = 0.0
-        
-        # Question words at the beginning increase probability
-        question_starters = ["come", "cosa", "perché", "quando", "dove", "chi", "quale", "quanto"]
-        if any(text.startswith(q) for q in question_starters):
-            probability += 0.3
-        
-        # Tech-related keywords that might confuse a boomer
-        tech_keywords = ["app", "wifi", "internet", "computer", "telefono", "whatsapp", "telegram", 
-                        "installare", "scaricare", "aggiornamento", "password", "email", "foto", 
-                        "video", "link", "browser", "google", "facebook", "instagram"]
-        tech_mentions = sum(1 for keyword in tech_keywords if keyword in text)
-        probability += min(tech_mentions * 0.15, 0.4)
-        
-        # Help-seeking phrases
-        help_phrases = ["aiuto", "aiutare", "spiegare", "non capisco", "non riesco", "come faccio", 
-                       "qualcuno sa", "qualcuno può", "che ne pensate", "cosa fate", "consigli"]
-        if any(phrase in text for phrase in help_phrases):
-            probability += 0.35
-        
-        # Question marks increase probability
-        if "?" in text:
-            probability += 0.2
-        
-        # Addressing the group in general
-        group_address = ["ragazzi", "tutti", "qualcuno", "ciao", "salve", "buongiorno", "buonasera"]
-        if any(addr in text for addr in group_address):
-            probability += 0.15
-        
-        # Confusion expressions (perfect for boomer personality)
-        confusion_words = ["confuso", "capire", "spiegazione", "non so", "boh", "mah"]
-        if any(word in text for word in confusion_words):
-            probability += 0.25
-        
-        return min(probability, 1.0)
+        return _address_probability(message_text.lower())
 
     def should_respond_to_message(self, message_data: Dict[str, Any]) -> bool:
         """Determine if the bot should respond to this message"""
-        logger = logging.getLogger(__name__)
         message = message_data['message']
-        message_text = message.text.lower() if message.text else ""
+        message_text = message_data.get('text_lower')
+        if message_text is None:
+            message_text = (message.text or "").lower()
         
         # Always respond to direct replies
         if message.reply_to_msg_id:
             logger.info("Responding to direct reply")
             return True
         
-        # Always respond to configured trigger words
-        if any(trigger in message_text for trigger in self.config.response.trigger_words):
+        # Always respond to configured trigger words; remembered so the rate-limit
+        # check in handle_new_message doesn't scan the text again
+        trigger_pattern = self._trigger_pattern
+        is_mention = bool(trigger_pattern and trigger_pattern.search(message_text))
+        message_data['is_mention'] = is_mention
+        if is_mention:
             logger.info("Responding to mention")
             return True
         
@@ -141,22 +229,23 @@ class TelegramClaudeBot:
             logger.info("Responding to image message")
             return True
         
+        # Sometimes respond to regular messages (reduced to 5% since we have smarter detection);
+        # rolled first so these messages skip the scoring entirely
+        if random.random() < 0.05:
+            logger.info("Randomly responding to regular message")
+            return True
+        
         # Calculate probability that message is addressed to bot
-        address_probability = self.calculate_address_probability(message_text)
+        address_probability = _address_probability(message_text) if message_text else 0.0
         if address_probability > 0.4:  # High probability threshold
-            logger.info(f"Responding to likely addressed message (probability: {address_probability:.2f})")
+            logger.info("Responding to likely addressed message (probability: %.2f)", address_probability)
             return True
         elif address_probability > 0.2:  # Medium probability with random chance
             if random.random() < address_probability:
-                logger.info(f"Responding to possibly addressed message (probability: {address_probability:.2f})")
+                logger.info("Responding to possibly addressed message (probability: %.2f)", address_probability)
                 return True
         
-        # Sometimes respond to regular messages (reduced to 5% since we have smarter detection)
-        if random.random() < 0.05:
-            logger.info("Randomly responding to regular message")
-            return True
-        
-        logger.debug(f"Not responding to message (address probability: {address_probability:.2f})")
+        logger.debug("Not responding to message (address probability: %.2f)", address_probability)
         return False
 
     def calculate_boomer_typing_time(self, message: str) -> float:
@@ -173,32 +262,30 @@ class TelegramClaudeBot:
         # Base typing speed: ~25 WPM = 125 characters per minute = ~2.1 chars/second
         base_chars_per_second = 4.0
         
-        # Count characters (spaces count as typing time too)
-        char_count = len(message)
+        # Deterministic message features (cached); randomness is applied on top
+        char_count, tech_mentions, punctuation_count = _typing_features(message)
         
         # Basic typing time
         typing_time = char_count / base_chars_per_second
         
-        # Add thinking pauses (more for longer messages)
-        thinking_pauses = min(char_count // 20, 5) * random.uniform(1.0, 3.0)
+        # Add thinking pauses (more for longer messages), ~1-3s each
+        thinking_pauses = min(char_count // 20, 5) * 2.0
         
-        # Add confusion factor for tech-related words
-        tech_words = ['app', 'wifi', 'internet', 'computer', 'telefono', 'whatsapp', 
-                     'telegram', 'password', 'email', 'foto', 'video', 'link']
-        tech_mentions = sum(1 for word in tech_words if word in message.lower())
-        confusion_time = tech_mentions * random.uniform(2.0, 5.0)
+        # Add confusion factor for tech-related words, ~2-5s each
+        confusion_time = tech_mentions * 3.5
         
-        # Add time for punctuation (boomers are careful with punctuation)
-        punctuation_count = sum(1 for char in message if char in '.,!?;:')
-        punctuation_time = punctuation_count * random.uniform(0.5, 1.5)
+        # Add time for punctuation (boomers are careful with punctuation), ~0.5-1.5s each
+        punctuation_time = punctuation_count * 1.0
         
-        # Random typing mistakes and corrections (10% chance per message)
-        mistake_time = 0.0
-        if random.random() < 0.1:
-            mistake_time = random.uniform(3.0, 8.0)
+        # One random draw drives all variation: the bottom decile triggers a typing
+        # mistake (10% chance, 3-8s to correct) and the position within the decile
+        # sets a +/-20% jitter on the whole time
+        r = random.random()
+        mistake_time = 3.0 + r * 50.0 if r < 0.1 else 0.0
+        jitter = 0.8 + 0.4 * ((r * 10.0) % 1.0)
         
         # Minimum time (always show typing for at least 2 seconds)
-        total_time = max(2.0, typing_time + thinking_pauses + confusion_time + punctuation_time + mistake_time)
+        total_time = max(2.0, (typing_time + thinking_pauses + confusion_time + punctuation_time + mistake_time) * jitter)
         
         # Maximum time (don't type for more than 60 seconds)
         total_time = min(180.0, total_time)
@@ -207,8 +294,6 @@ class TelegramClaudeBot:
 
     async def generate_startup_greeting(self) -> Optional[str]:
         """Generate a greeting message based on recent chat context"""
-        logger = logging.getLogger(__name__)
-        
         try:
             # Get recent messages for context
             recent_messages = await self.telegram_bot.get_startup_context(50)
@@ -219,15 +304,10 @@ class TelegramClaudeBot:
             
             # Create context data for the AI
             startup_context = {
-                'message': type('obj', (object,), {
-                    'text': '[BOT STARTUP - Generate a natural greeting based on recent conversation]',
-                    'reply_to_msg_id': None
-                })(),
-                'sender': type('obj', (object,), {
-                    'first_name': 'Sistema'
-                })(),
+                'message': _StartupMsg('[BOT STARTUP - Generate a natural greeting based on recent conversation]'),
+                'sender': _StartupSender(),
                 'context': recent_messages[-20:],  # Last 20 messages for context
-                'group_name': self.telegram_bot.selected_group['name']
+                'group_name': self.telegram_bot.selected_group.name
             }
             
             # Get AI response for startup greeting
@@ -242,52 +322,51 @@ class TelegramClaudeBot:
 
     async def handle_new_message(self, message_data: Dict[str, Any]):
         """Handle incoming messages"""
-        logger = logging.getLogger(__name__)
-        
         try:
             # Skip if it's a bot message and we're configured to ignore bots
             sender = message_data['sender']
-            if self.config.safety.ignore_bots and hasattr(sender, 'bot') and sender.bot:
+            if self._ignore_bots and getattr(sender, 'bot', False):
                 logger.debug("Skipping bot message")
                 return
             
+            # Lowercase once; the response checks below all work on this copy
+            message_data['text_lower'] = (message_data['message'].text or "").lower()
+            
             # Check if we should respond to this message
             if not self.should_respond_to_message(message_data):
                 return
             
             # Check rate limits (but allow direct replies and mentions even if rate limited)
             message = message_data['message']
-            message_text = message.text.lower() if message.text else ""
-            is_direct = message.reply_to_msg_id or any(trigger in message_text for trigger in self.config.response.trigger_words)
+            is_direct = message.reply_to_msg_id or message_data.get('is_mention', False)
             
             if not is_direct and not self.rate_limiter.can_send_message():
                 logger.warning("Rate limit exceeded, skipping non-direct message")
                 return
             
+            # Only fetch the conversation context once we know we're responding,
+            # and skip it for replies to our own messages (the quoted message is enough)
+            if message_data.get('replied_to_text') is None:
+                message_data['context'] = await self.telegram_bot.get_message_context(message)
+            
             # Add random delay for natural feel (thinking time)
-            thinking_delay = random.uniform(
-                self.config.response.delay_min,
-                self.config.response.delay_max
-            )
-            logger.info(f"Thinking for {thinking_delay:.1f}s before responding")
+            thinking_delay = random.uniform(self._delay_min, self._delay_max)
+            logger.info("Thinking for %.1fs before responding", thinking_delay)
             await asyncio.sleep(thinking_delay)
             
             # Get AI response with typing indicator
             logger.info("Getting response from AI")
             
-            async def process_ai_response():
-                return await self.claude_handler.process_message(message_data)
-            
             # Show typing while AI processes the message
             response = await self.telegram_bot.type_while_processing(
-                process_ai_response(),
-                typing_interval=4.0
+                self.claude_handler.process_message(message_data),
+                typing_interval=TYPING_INTERVAL
             )
             
             if response:
                 # Calculate realistic typing time for the response
                 typing_time = self.calculate_boomer_typing_time(response)
-                logger.info(f"Will type for {typing_time:.1f}s to simulate boomer typing speed")
+                logger.info("Will type for %.1fs to simulate boomer typing speed", typing_time)
                 
                 # Show typing indicator for calculated time
                 await self.telegram_bot.start_typing()
@@ -310,8 +389,6 @@ class TelegramClaudeBot:
     
     async def select_group_interactive(self):
         """Interactive group selection"""
-        logger = logging.getLogger(__name__)
-        
         # Display available groups
         groups = await self.telegram_bot.display_groups()
         
@@ -330,7 +407,7 @@ class TelegramClaudeBot:
                 group_index = int(selection) - 1
                 
                 if await self.telegram_bot.select_group(group_index, groups):
-                    print(f"\n✓ Selected: {groups[group_index]['name']}")
+                    print(f"\n✓ Selected: {groups[group_index].name}")
                     return True
                 else:
                     print("Invalid selection. Please try again.")
@@ -342,7 +419,8 @@ class TelegramClaudeBot:
     
     async def run(self):
         """Main bot loop"""
-        logger = logging.getLogger(__name__)
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
         
         try:
             # Initialize components
@@ -362,7 +440,7 @@ class TelegramClaudeBot:
             await self.telegram_bot.start_monitoring()
             
             print(f"\n✓ Bot is now active!")
-            print(f"Monitoring group: {self.telegram_bot.selected_group['name']}")
+            print(f"Monitoring group: {self.telegram_bot.selected_group.name}")
             print(f"Personality: {self.config.claude.personality[:50]}...")
             print(f"Rate limit: {self.config.safety.rate_limit_messages} messages per {self.config.safety.rate_limit_window}s")
             
@@ -388,11 +466,8 @@ class TelegramClaudeBot:
             
             print("\nPress Ctrl+C to stop the bot.\n")
             
-            self.running = True
-            
-            # Keep the bot running
-            while self.running:
-                await asyncio.sleep(1)
+            # Keep the bot running until stop() is called
+            await self._stop_event.wait()
                 
         except KeyboardInterrupt:
             logger.info("Received interrupt signal")
@@ -402,11 +477,14 @@ class TelegramClaudeBot:
             # Cleanup
             if self.telegram_bot:
                 await self.telegram_bot.disconnect()
+            if self.claude_handler:
+                await self.claude_handler.aclose()
             logger.info("Bot stopped")
     
     def stop(self):
-        """Stop the bot"""
-        self.running = False
+        """Stop the bot; safe to call from a signal handler"""
+        if self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
 
 
 async def main():
@@ -426,5 +504,12 @@ async def main():
 
 
 if __name__ == "__main__":
+    # Use uvloop's faster event loop when it's installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
     # Run the async main function
     asyncio.run(main())
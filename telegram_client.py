@@ -1,18 +1,52 @@
 import asyncio
 import logging
-import base64
+import binascii
 import mimetypes
 import io
+import os
+import time
+import orjson
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
-from typing import List, Optional, Dict, Any
-from telethon import TelegramClient, events, functions, types
-from telethon.tl.types import Dialog, Channel, Chat, User, Message
+from operator import attrgetter
+from typing import List, Optional, Dict, Any, Tuple
+from telethon import TelegramClient, events, functions, types, utils
+from telethon.tl.types import Channel, Chat, User, Message
 from telethon.tl.functions.messages import GetDialogsRequest
 from telethon.errors import SessionPasswordNeededError
 from config import TelegramConfig
 
 logger = logging.getLogger(__name__)
 
+# How many of our own sent messages to remember for reply detection
+_OWN_MESSAGES_MAX = 200
+# How many replied-to messages to keep so repeated context builds skip the fetch
+_MESSAGE_CACHE_MAX = 256
+# Bound on new-message events waiting to be handled
+_EVENT_QUEUE_MAX = 64
+# How many new-message events are handled at once
+_EVENT_CONSUMERS = 4
+# How long a fetched message context is reused for other messages
+_CONTEXT_REUSE_SECONDS = 1.0
+# Startup context saved between runs, so a restart only fetches newer messages
+_CONTEXT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nonno", "context.json")
+_CONTEXT_CACHE_MAX_BYTES = 10 * 1024 * 1024
+# Dialogs per GetDialogsRequest page (the most Telegram returns at once)
+_DIALOGS_PAGE_SIZE = 100
+
+
+@dataclass(slots=True)
+class GroupEntry:
+    """A group the bot can monitor, as listed by get_groups"""
+    id: int
+    name: str
+    entity: Any
+    dialog: Any
+    unread_count: int
+    last_message_date: datetime
+    participants_count: Any
+
 
 class TelegramBot:
     """Telegram client for monitoring and responding to messages"""
@@ -24,8 +58,19 @@ class TelegramBot:
             config.api_id,
             config.api_hash
         )
-        self.selected_group: Optional[Dialog] = None
+        self.selected_group: Optional[GroupEntry] = None
         self.message_handler = None
+        self._own_messages: OrderedDict[int, str] = OrderedDict()
+        # Senders by peer id, and replied-to messages by (chat id, message id)
+        self._sender_cache: Dict[int, Any] = {}
+        self._message_cache: OrderedDict[tuple, Optional[Message]] = OrderedDict()
+        # New-message events waiting for the consumers started by start_monitoring
+        self._event_queue: asyncio.Queue = asyncio.Queue(maxsize=_EVENT_QUEUE_MAX)
+        self._event_consumers: List[asyncio.Task] = []
+        # Recent context fetch, shared by messages handled close together
+        self._context_cache: Optional[Tuple[float, int, asyncio.Future]] = None
+        # Bot senders seen in the monitored group, so their later messages exit early
+        self._known_bot_ids: set = set()
         
     async def start(self):
         """Start the Telegram client and authenticate"""
@@ -37,45 +82,78 @@ class TelegramBot:
             logger.error("Run: python main.py")
             raise RuntimeError("First-time authentication required. Please run interactively.")
         
-    async def get_groups(self) -> List[Dict[str, Any]]:
+    async def get_groups(self) -> List[GroupEntry]:
         """Get all groups/channels sorted by last message time"""
         dialogs = []
         # Calculate 48 hours ago
         cutoff_time = datetime.now(timezone.utc) - timedelta(hours=48)
         
-        async for dialog in self.client.iter_dialogs():
-            # Only include groups and channels
-            if isinstance(dialog.entity, (Channel, Chat)):
+        # Dialogs come newest first, so a single page normally covers the last 48 hours;
+        # only ask for the next page while the oldest dialog seen is still recent
+        offset_date, offset_id, offset_peer = None, 0, types.InputPeerEmpty()
+        seen = set()
+        while True:
+            result = await self.client(GetDialogsRequest(
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_peer=offset_peer,
+                limit=_DIALOGS_PAGE_SIZE,
+                hash=0,
+                folder_id=0  # Main list only; archived chats aren't candidates
+            ))
+            entities = {utils.get_peer_id(e): e for e in (*result.users, *result.chats)}
+            # Message ids are only unique per chat; a MessageEmpty may carry no peer at all
+            last_messages = {(utils.get_peer_id(m.peer_id), m.id): m for m in result.messages if m.peer_id}
+            
+            for dialog in result.dialogs:
+                peer_id = utils.get_peer_id(dialog.peer)
+                if peer_id in seen:
+                    continue
+                seen.add(peer_id)
+                entity = entities.get(peer_id)
+                message = last_messages.get((peer_id, dialog.top_message))
+                
+                # Only include groups and channels
+                if not isinstance(entity, (Channel, Chat)):
+                    continue
+                
                 # Skip if it's a broadcast channel (not a group)
-                if hasattr(dialog.entity, 'broadcast') and dialog.entity.broadcast:
+                if getattr(entity, 'broadcast', False):
                     continue
                 
                 # Skip if no message or message is older than 48 hours
-                if not dialog.message or not dialog.message.date:
-                    continue
-                    
-                if dialog.message.date < cutoff_time:
+                if not message or not message.date or message.date < cutoff_time:
                     continue
                 
-                dialogs.append({
-                    'id': dialog.id,
-                    'name': dialog.name,
-                    'entity': dialog.entity,
-                    'dialog': dialog,
-                    'unread_count': dialog.unread_count,
-                    'last_message_date': dialog.message.date,
-                    'participants_count': getattr(dialog.entity, 'participants_count', 'Unknown')
-                })
+                dialogs.append(GroupEntry(
+                    id=peer_id,
+                    name=entity.title,
+                    entity=entity,
+                    dialog=dialog,
+                    unread_count=dialog.unread_count,
+                    last_message_date=message.date,
+                    participants_count=getattr(entity, 'participants_count', 'Unknown')
+                ))
+            
+            if len(result.dialogs) < _DIALOGS_PAGE_SIZE or isinstance(result, types.messages.Dialogs):
+                break
+            last_peer_id = utils.get_peer_id(result.dialogs[-1].peer)
+            last_message = last_messages.get((last_peer_id, result.dialogs[-1].top_message))
+            if not last_message or last_message.date < cutoff_time or last_peer_id not in entities:
+                break
+            offset_date = last_message.date
+            offset_id = last_message.id
+            offset_peer = utils.get_input_peer(entities[last_peer_id])
         
         # Sort by last message date (most recent first)
         dialogs.sort(
-            key=lambda x: x['last_message_date'],
+            key=attrgetter('last_message_date'),
             reverse=True
         )
         
         return dialogs
     
-    async def display_groups(self) -> List[Dict[str, Any]]:
+    async def display_groups(self) -> List[GroupEntry]:
         """Display available groups and return the list"""
         groups = await self.get_groups()
         
@@ -83,54 +161,125 @@ class TelegramBot:
             logger.warning("No groups found with activity in the last 48 hours")
             return []
         
-        print("\n=== Available Groups (active in last 48 hours) ===\n")
+        lines = ["\n=== Available Groups (active in last 48 hours) ===\n"]
         now = datetime.now(timezone.utc)
         
         for i, group in enumerate(groups, 1):
             # Calculate time ago
-            time_diff = now - group['last_message_date']
-            hours_ago = int(time_diff.total_seconds() / 3600)
-            minutes_ago = int((time_diff.total_seconds() % 3600) / 60)
+            seconds_ago = int((now - group.last_message_date).total_seconds())
+            hours_ago, remainder = divmod(seconds_ago, 3600)
+            minutes_ago = remainder // 60
+            time_ago = f"{hours_ago}h {minutes_ago}m ago" if hours_ago > 0 else f"{minutes_ago}m ago"
             
-            if hours_ago > 0:
-                time_ago = f"{hours_ago}h {minutes_ago}m ago"
-            else:
-                time_ago = f"{minutes_ago}m ago"
-            
-            print(f"{i}. {group['name']}")
-            print(f"   Members: {group['participants_count']}")
-            print(f"   Last message: {time_ago}")
-            print(f"   Unread: {group['unread_count']}")
-            print()
+            lines.append(f"{i}. {group.name}")
+            lines.append(f"   Members: {group.participants_count}")
+            lines.append(f"   Last message: {time_ago}")
+            lines.append(f"   Unread: {group.unread_count}")
+            lines.append("")
+        
+        # One write for the whole listing
+        print("\n".join(lines))
         
         return groups
     
-    async def select_group(self, group_index: int, groups: List[Dict[str, Any]]) -> bool:
+    async def select_group(self, group_index: int, groups: List[GroupEntry]) -> bool:
         """Select a group to monitor"""
         if 0 <= group_index < len(groups):
             self.selected_group = groups[group_index]
-            logger.info(f"Selected group: {self.selected_group['name']}")
+            logger.info(f"Selected group: {self.selected_group.name}")
             return True
         else:
             logger.error("Invalid group selection")
             return False
     
+    @staticmethod
+    def _sender_info(sender) -> Tuple[str, bool]:
+        """Return (display name, is bot) for a message sender"""
+        # Telethon hands back exact TL classes, so an identity check on the type is enough
+        sender_type = type(sender)
+        if sender_type is User:
+            return sender.first_name or sender.username or f"User {sender.id}", bool(sender.bot)
+        if sender_type is Channel or sender_type is Chat:
+            return sender.title, False
+        return "Unknown", False
+    
+    async def _resolve_senders(self, messages: List[Message]):
+        """Fill the sender cache for these messages, fetching unknown senders in one request"""
+        missing = set()
+        for message in messages:
+            if message.sender is not None:
+                self._sender_cache[message.sender_id] = message.sender
+            elif message.sender_id and message.sender_id not in self._sender_cache:
+                missing.add(message.sender_id)
+        
+        if not missing:
+            return
+        
+        try:
+            entities = await self.client.get_entity(list(missing))
+            for entity in entities:
+                self._sender_cache[utils.get_peer_id(entity)] = entity
+        except Exception as e:
+            logger.warning(f"Could not resolve message senders: {e}")
+    
+    async def _fetch_replied_messages(self, reply_ids: List[int]):
+        """Fetch replied-to messages not already cached, in one request"""
+        chat_id = self.selected_group.id
+        missing = [msg_id for msg_id in reply_ids if (chat_id, msg_id) not in self._message_cache]
+        
+        if missing:
+            try:
+                fetched = await self.client.get_messages(self.selected_group.entity, ids=missing)
+                for msg_id, replied_msg in zip(missing, fetched):
+                    self._message_cache[(chat_id, msg_id)] = replied_msg
+                    if len(self._message_cache) > _MESSAGE_CACHE_MAX:
+                        self._message_cache.popitem(last=False)
+            except Exception as e:
+                logger.warning(f"Could not fetch replied messages: {e}")
+        
+        replied = {}
+        for msg_id in reply_ids:
+            key = (chat_id, msg_id)
+            if key in self._message_cache:
+                self._message_cache.move_to_end(key)
+                replied[msg_id] = self._message_cache[key]
+        return replied
+    
     async def get_message_context(self, event_message: Message, limit: int = 20) -> List[Dict[str, Any]]:
         """Get message context including previous messages and replies"""
+        # Messages in the same burst see the same window, so reuse a fetch that is
+        # recent (or still in flight) instead of starting another one
+        now = time.monotonic()
+        cached = self._context_cache
+        if cached is None or cached[1] != limit or now - cached[0] > _CONTEXT_REUSE_SECONDS:
+            cached = (now, limit, asyncio.ensure_future(self._fetch_window(limit)))
+            self._context_cache = cached
+        
+        # Shielded so one cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(cached[2])
+    
+    async def _fetch_window(self, limit: int, min_id: int = 0) -> List[Dict[str, Any]]:
+        """Build context entries for the latest messages in the selected group, newer than min_id"""
         messages = []
         
-        # Get recent messages from the chat
-        async for message in self.client.iter_messages(
-            self.selected_group['entity'],
-            limit=limit
-        ):
-            sender = await message.get_sender()
-            sender_name = "Unknown"
-            
-            if isinstance(sender, User):
-                sender_name = sender.first_name or sender.username or f"User {sender.id}"
-            elif isinstance(sender, (Channel, Chat)):
-                sender_name = sender.title
+        # Get recent messages from the chat, then resolve replies and senders in batches
+        window = [message async for message in self.client.iter_messages(
+            self.selected_group.entity,
+            limit=limit,
+            min_id=min_id
+        )]
+        # Replies usually point at nearby messages, so only fetch those outside the window
+        by_id = {message.id: message for message in window}
+        replied = await self._fetch_replied_messages(list({
+            message.reply_to_msg_id for message in window
+            if message.reply_to_msg_id and message.reply_to_msg_id not in by_id
+        }))
+        await self._resolve_senders(window + [m for m in replied.values() if m])
+        replied.update(by_id)
+        
+        # The window is newest first; walk it backwards to build chronological order
+        for message in reversed(window):
+            sender_name, is_bot = self._sender_info(self._sender_cache.get(message.sender_id))
             
             msg_data = {
                 'id': message.id,
@@ -139,42 +288,25 @@ class TelegramBot:
                 'sender_name': sender_name,
                 'date': message.date,
                 'reply_to_msg_id': message.reply_to_msg_id,
-                'is_bot': getattr(sender, 'bot', False) if isinstance(sender, User) else False,
-                'image': None  # Will be populated if message has photo
+                'is_bot': is_bot
             }
             
-            # Download and encode image if present
+            # Prompts only use context text, so photos are noted but never downloaded
             if message.photo:
-                image_data = await self.download_and_encode_image(message)
-                if image_data:
-                    msg_data['image'] = image_data
-                    msg_data['text'] = message.text or "[Foto]"  # Italian for "Photo"
+                msg_data['text'] = message.text or "[Foto]"  # Italian for "Photo"
             
-            # If this message is a reply, try to get the original message
-            if message.reply_to_msg_id:
-                try:
-                    replied_msg = await self.client.get_messages(
-                        self.selected_group['entity'],
-                        ids=message.reply_to_msg_id
-                    )
-                    if replied_msg:
-                        replied_sender = await replied_msg.get_sender()
-                        replied_sender_name = "Unknown"
-                        if isinstance(replied_sender, User):
-                            replied_sender_name = replied_sender.first_name or replied_sender.username
-                        
-                        msg_data['replied_to'] = {
-                            'text': replied_msg.text or "[Media/Other content]",
-                            'sender_name': replied_sender_name
-                        }
-                except Exception as e:
-                    logger.warning(f"Could not fetch replied message: {e}")
+            # If this message is a reply, attach the original message
+            replied_msg = replied.get(message.reply_to_msg_id) if message.reply_to_msg_id else None
+            if replied_msg:
+                replied_sender_name, _ = self._sender_info(self._sender_cache.get(replied_msg.sender_id))
+                
+                msg_data['replied_to'] = {
+                    'text': replied_msg.text or "[Media/Other content]",
+                    'sender_name': replied_sender_name
+                }
             
             messages.append(msg_data)
         
-        # Reverse to get chronological order
-        messages.reverse()
-        
         return messages
     
     async def get_startup_context(self, limit: int = 50) -> List[Dict[str, Any]]:
@@ -182,16 +314,48 @@ class TelegramBot:
         if not self.selected_group:
             return []
         
-        # Use the existing get_message_context method but with a dummy message
-        dummy_message = type('obj', (object,), {
-            'id': 0,
-            'text': '',
-            'sender_id': 0,
-            'date': datetime.now(timezone.utc),
-            'reply_to_msg_id': None
-        })()
+        # Start from the context saved by the last run and only fetch what's newer
+        chat_key = str(self.selected_group.id)
+        cache = self._load_context_cache()
+        cached = cache.get(chat_key, [])
+        last_id = cached[-1]['id'] if cached else 0
         
-        return await self.get_message_context(dummy_message, limit=limit)
+        messages = (cached + await self._fetch_window(limit, min_id=last_id))[-limit:]
+        
+        cache[chat_key] = messages
+        self._save_context_cache(cache)
+        return messages
+
+    @staticmethod
+    def _load_context_cache() -> Dict[str, List[Dict[str, Any]]]:
+        """Load saved startup contexts by chat id, or nothing if there are none"""
+        try:
+            with open(_CONTEXT_CACHE_PATH, 'rb') as f:
+                cache = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return {}
+        
+        for messages in cache.values():
+            for msg in messages:
+                msg['date'] = datetime.fromisoformat(msg['date']) if msg['date'] else None
+        return cache
+
+    @staticmethod
+    def _save_context_cache(cache: Dict[str, List[Dict[str, Any]]]):
+        """Save startup contexts, replacing the file atomically so a crash can't corrupt it"""
+        try:
+            data = orjson.dumps(cache)
+            if len(data) > _CONTEXT_CACHE_MAX_BYTES:
+                logger.warning("Startup context cache too large, not saving it")
+                return
+            
+            os.makedirs(os.path.dirname(_CONTEXT_CACHE_PATH), exist_ok=True)
+            tmp_path = f"{_CONTEXT_CACHE_PATH}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, _CONTEXT_CACHE_PATH)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not save startup context cache: {e}")
 
     async def download_and_encode_image(self, message: Message) -> Optional[Dict[str, str]]:
         """Download image from message and encode as base64"""
@@ -199,15 +363,18 @@ class TelegramBot:
             if not message.photo:
                 return None
             
-            # Download the image to memory
-            image_bytes = await self.client.download_media(message.photo, file=bytes)
+            # Download the image into a buffer
+            buffer = io.BytesIO()
+            await self.client.download_media(message.photo, file=buffer)
             
-            if not image_bytes:
-                logger.warning("Failed to download image bytes")
-                return None
-            
-            # Encode to base64
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+            # Encode straight from the buffer's memory (the output is pure ASCII,
+            # so skip the UTF-8 decoder)
+            with buffer, buffer.getbuffer() as image_bytes:
+                if not image_bytes.nbytes:
+                    logger.warning("Failed to download image bytes")
+                    return None
+                
+                encoded_image = binascii.b2a_base64(image_bytes, newline=False).decode('ascii')
             
             # Determine MIME type (default to JPEG for Telegram photos)
             mime_type = "image/jpeg"
@@ -230,32 +397,41 @@ class TelegramBot:
         if not self.selected_group:
             raise ValueError("No group selected")
         
-        @self.client.on(events.NewMessage(chats=self.selected_group['entity']))
-        async def handle_new_message(event):
+        # Filter on the marked integer peer id, which Telethon matches without
+        # resolving an entity; the closure reads the group from a local
+        group = self.selected_group
+        chat_id = utils.get_peer_id(group.entity)
+        
+        async def dispatch(event):
             try:
-                # Get sender information
-                sender = await event.get_sender()
+                # Get sender information, resolving it only if Telethon didn't attach it
+                sender_id = event.message.sender_id
+                sender = event.message.sender or self._sender_cache.get(sender_id) or await event.get_sender()
                 
                 # Skip if sender is a bot (based on config)
-                if isinstance(sender, User) and sender.bot:
-                    logger.debug(f"Skipping message from bot: {sender.username}")
+                sender_name, is_bot = self._sender_info(sender)
+                if is_bot:
+                    self._known_bot_ids.add(sender_id)
+                    logger.debug(f"Skipping message from bot: {sender_name}")
                     return
                 
-                # Get message context
-                context = await self.get_message_context(event.message)
-                
                 # Download image if present in the new message
                 current_message_image = None
                 if event.message.photo:
                     current_message_image = await self.download_and_encode_image(event.message)
                 
-                # Prepare message data
+                # A reply to one of our own messages only needs that message as context
+                reply_to = event.message.reply_to_msg_id
+                replied_to_text = self._own_messages.get(reply_to) if reply_to else None
+                
+                # Prepare message data (context is fetched by the handler only if it responds)
                 message_data = {
                     'message': event.message,
                     'sender': sender,
-                    'context': context,
-                    'group_name': self.selected_group['name'],
-                    'current_image': current_message_image
+                    'group_id': group.id,
+                    'group_name': group.name,
+                    'current_image': current_message_image,
+                    'replied_to_text': replied_to_text
                 }
                 
                 # Call the message handler if set
@@ -265,7 +441,27 @@ class TelegramBot:
             except Exception as e:
                 logger.error(f"Error handling new message: {e}", exc_info=True)
         
-        logger.info(f"Started monitoring group: {self.selected_group['name']}")
+        async def consume_events():
+            # A fixed pool of consumers bounds how many events are handled at once, so a
+            # long reply doesn't hold up later messages; context fetches close together share one result
+            while True:
+                event = await self._event_queue.get()
+                await dispatch(event)
+        
+        @self.client.on(events.NewMessage(chats=chat_id))
+        async def handle_new_message(event):
+            # Never respond to our own messages
+            if event.message.out:
+                return
+            
+            # Senders already known to be bots are dropped before any lookup
+            if event.message.sender_id in self._known_bot_ids:
+                return
+            
+            await self._event_queue.put(event)
+        
+        self._event_consumers = [asyncio.create_task(consume_events()) for _ in range(_EVENT_CONSUMERS)]
+        logger.info(f"Started monitoring group: {self.selected_group.name}")
         
     async def start_typing(self):
         """Start showing typing indicator"""
@@ -274,7 +470,7 @@ class TelegramBot:
         
         try:
             await self.client(functions.messages.SetTypingRequest(
-                peer=self.selected_group['entity'],
+                peer=self.selected_group.entity,
                 action=types.SendMessageTypingAction()
             ))
         except Exception as e:
@@ -287,24 +483,23 @@ class TelegramBot:
         
         try:
             await self.client(functions.messages.SetTypingRequest(
-                peer=self.selected_group['entity'],
+                peer=self.selected_group.entity,
                 action=types.SendMessageCancelAction()
             ))
         except Exception as e:
             logger.warning(f"Failed to stop typing indicator: {e}")
 
-    async def type_while_processing(self, processing_task, typing_interval: float = 4.0):
+    async def type_while_processing(self, processing_task, typing_interval: float = 5.0):
         """Show typing indicator while processing a task"""
         if not self.selected_group:
             return await processing_task
         
-        typing_active = True
-        
         async def keep_typing():
-            while typing_active:
+            # Telegram shows the typing action for ~6s, so refresh it just before it lapses
+            while True:
                 try:
                     await self.client(functions.messages.SetTypingRequest(
-                        peer=self.selected_group['entity'],
+                        peer=self.selected_group.entity,
                         action=types.SendMessageTypingAction()
                     ))
                     await asyncio.sleep(typing_interval)
@@ -320,8 +515,7 @@ class TelegramBot:
             result = await processing_task
             return result
         finally:
-            # Stop typing
-            typing_active = False
+            # Stop typing, even if a typing request is still in flight
             typing_task.cancel()
             try:
                 await typing_task
@@ -334,14 +528,23 @@ class TelegramBot:
         if not self.selected_group:
             raise ValueError("No group selected")
         
-        await self.client.send_message(
-            self.selected_group['entity'],
+        sent = await self.client.send_message(
+            self.selected_group.entity,
             text,
             reply_to=reply_to
         )
-        logger.info(f"Sent message to {self.selected_group['name']}")
+        
+        # Remember what we sent so replies to it can be recognized
+        self._own_messages[sent.id] = text
+        if len(self._own_messages) > _OWN_MESSAGES_MAX:
+            self._own_messages.popitem(last=False)
+        
+        logger.info(f"Sent message to {self.selected_group.name}")
     
     async def disconnect(self):
         """Disconnect from Telegram"""
+        for task in self._event_consumers:
+            task.cancel()
+        await asyncio.gather(*self._event_consumers, return_exceptions=True)
         await self.client.disconnect()
         logger.info("Disconnected from Telegram")
\ No newline at end of file